@@ -1,9 +1,21 @@
 # Import necessary libraries for the script
 import os  # For interacting with the operating system
-import shutil  # For file operations like moving files
+import io  # For encoding images in memory
 import sys  # Access to some variables used or maintained by the interpreter
+import hashlib  # For hashing image contents into cache keys
+import json  # For reading and writing cached metadata
+import re  # For filtering file name parts out of the custom context
+import tempfile  # For writing cache entries atomically
 import requests  # To make HTTP requests to a specified URL
+from requests.adapters import HTTPAdapter  # For connection pooling and retries
+from urllib3.util.retry import Retry  # To retry transient API failures
 import csv  # For reading and writing CSV files
+import multiprocessing  # For choosing how image encoding processes are started
+from concurrent.futures import (  # For concurrent API requests and image encoding
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from PIL import Image  # For downsizing images
 from PyQt5.QtWidgets import (
     QApplication,
@@ -14,66 +26,198 @@ from PyQt5.QtWidgets import (
     QFileDialog,
     QTextEdit,
 )
+from PyQt5.QtCore import QObject, QThread, Qt, pyqtSignal
+
+# Use orjson for faster JSON decoding and encoding when it is installed
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
 
 # Variable to store your API token for authentication
 api_token = ""  # Replace with your API token from https://www.phototag.ai/api
+# Number of images uploaded to the API at the same time
+max_concurrent_requests = 8
+# Number of CSV rows collected before they are written to the file
+csv_batch_size = 64
+# File name parts left out of the custom context: a lone 'g' or a number
+skip_context_part = re.compile(r"g|\d+")
+
+# Shared HTTP session so connections to the API are kept alive and reused
+# across images instead of opening a new TLS connection for every upload
+session = requests.Session()
+session.headers.update({"Authorization": f"Bearer {api_token}"})
+session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=max_concurrent_requests,
+        pool_maxsize=max_concurrent_requests,
+        # Only resend after the listed statuses; a read timeout may mean the
+        # API already handled (and billed) the upload
+        max_retries=Retry(
+            total=3,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            raise_on_status=False,
+        ),
+    ),
+)
 
 
-def downsize_image(image_path, max_size_mb=10):
+def encode_for_upload(image_path, max_size_mb=10, original_size=None):
     """
-    Downsize an image if it exceeds the specified maximum file size in MB.
-    Returns the path to the downsized image (overwrites the original file).
+    Returns the image bytes to upload and the file name to send them under.
+    Images over the specified maximum file size in MB are re-encoded in memory;
+    the original file is left untouched. The file size is looked up unless
+    it is already known and passed in as original_size.
     """
     max_size_bytes = max_size_mb * 1024 * 1024
-    original_size = os.path.getsize(image_path)
+    if original_size is None:
+        original_size = os.path.getsize(image_path)
+    filename = os.path.basename(image_path)
 
     # If image size is already under the limit, no downsizing is needed.
     if original_size <= max_size_bytes:
-        return image_path
+        with open(image_path, "rb") as img_file:
+            return img_file.read(), filename
 
     img = Image.open(image_path)
-    # Ensure we are saving as JPEG even if extension is JPG/JPEG.
-    temp_file = image_path + "_temp.jpg"
-    quality = 95
+    # Use the fast JPEG decoder path, decoding straight to RGB
+    img.draft("RGB", img.size)
+
+    def encode(quality):
+        # Encode the image in memory at the given quality
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", optimize=True, quality=quality)
+        return buffer
+
+    # Halve the dimensions while even a medium quality doesn't fit, since
+    # fewer pixels shrink the file far more than lower quality does
+    while encode(60).tell() > max_size_bytes and min(img.size) > 512:
+        img = img.reduce(2)
 
-    # Reduce image quality in steps until it's under the desired size or we reach very low quality
-    while True:
-        img.save(temp_file, format="JPEG", optimize=True, quality=quality)
-        if os.path.getsize(temp_file) <= max_size_bytes or quality <= 5:
-            break
-        quality -= 5
+    # Binary search for the highest quality that fits under the size limit,
+    # falling back to the lowest quality if none of them fit
+    low, high = 5, 95
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        buffer = encode(quality)
+        if buffer.tell() <= max_size_bytes:
+            best = buffer
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        # Nothing fit, so the last buffer tried is the lowest quality one
+        best = buffer
 
-    # Overwrite the original file with the downsized version
-    shutil.move(temp_file, image_path)
+    return best.getvalue(), filename
 
-    return image_path
+
+def get_cache_path(image_path, custom_context, image_data=None):
+    """
+    Returns the path of the cache entry for an image, keyed by a hash of the
+    custom context and the image contents. Cache entries live in a
+    .phototag_cache folder next to the images. The contents are hashed from
+    image_data when it has already been read, otherwise from the file in chunks.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    key.update(custom_context.encode("utf-8"))
+    if image_data is not None:
+        key.update(image_data)
+    else:
+        with open(image_path, "rb") as img_file:
+            for chunk in iter(lambda: img_file.read(1 << 20), b""):
+                key.update(chunk)
+    cache_dir = os.path.join(os.path.dirname(image_path), ".phototag_cache")
+    return os.path.join(cache_dir, f"{key.hexdigest()}.json")
+
+
+def write_cache(cache_path, title, description, keywords):
+    """
+    Stores fetched metadata in the cache. The entry is written to a temporary
+    file first and then moved into place so a partial write is never read back.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=cache_dir, suffix=".tmp", delete=False
+        ) as tmp_file:
+            tmp_path = tmp_file.name
+            tmp_file.write(json_dumps([title, description, keywords]))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Don't leave a partial temporary file behind
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
-def get_image_metadata(image_path, custom_context):
+def get_image_metadata(image_path, custom_context, encode_pool=None, image_size=None):
     """
     Fetches metadata for an image using the PhotoTag.ai API.
 
     :param image_path: The path to the image file.
     :param custom_context: A string of custom context to improve API results.
+    :param encode_pool: An optional process pool used to re-encode oversized images.
+    :param image_size: The size of the image file in bytes, if already known.
     """
     # The URL of the API endpoint
     url = "https://server.phototag.ai/api/keywords"
-    # Headers for the request, including the authorization token
-    headers = {"Authorization": f"Bearer {api_token}"}
     # The payload of the request, including language, maximum keywords, and custom context
     payload = {"language": "en", "maxKeywords": 40, "customContext": custom_context}
 
-    # Downsize the image if necessary before sending
-    downsize_image(image_path, max_size_mb=10)
+    max_size_mb = 10
+    if image_size is None:
+        image_size = os.path.getsize(image_path)
 
-    # Open the image file in binary mode and send the request
-    with open(image_path, "rb") as img_file:
-        files = {"file": img_file}
-        response = requests.post(url, headers=headers, data=payload, files=files)
+    # Images under the size limit are read once and the same bytes are used
+    # for both the cache key and the upload
+    img_data = None
+    if image_size <= max_size_mb * 1024 * 1024:
+        with open(image_path, "rb") as img_file:
+            img_data = img_file.read()
+
+    # Return the stored metadata if this image was already processed
+    cache_path = get_cache_path(image_path, custom_context, img_data)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as cache_file:
+            title, description, keywords = json_loads(cache_file.read())
+        print(f"Metadata loaded from cache for image: {image_path}")
+        return title, description, keywords
+
+    # Downsize oversized images in memory before sending. They are
+    # re-encoded in a separate process so several can be compressed at once
+    # across CPU cores while other uploads are in flight.
+    if img_data is not None:
+        filename = os.path.basename(image_path)
+    elif encode_pool is not None:
+        img_data, filename = encode_pool.submit(
+            encode_for_upload, image_path, max_size_mb, image_size
+        ).result()
+    else:
+        img_data, filename = encode_for_upload(image_path, max_size_mb, image_size)
+
+    # Send the request. The multipart body is built in memory rather than
+    # streamed so the session's retries can send it again after a failure.
+    files = {"file": (filename, img_data, "image/jpeg")}
+    response = session.post(url, data=payload, files=files, timeout=(5, 60))
 
     # If the request is successful (status code 200), process the data
     if response.status_code == 200:
-        data = response.json().get("data")
+        data = json_loads(response.content).get("data")
         if data:
             # Extract the title, description, and keywords from the response
             title = data.get("title", "")
@@ -84,6 +228,12 @@ def get_image_metadata(image_path, custom_context):
             print(f"Title: {title}")
             print(f"Description: {description}")
             print(f"Keywords: {keywords}")
+            # The metadata has already been fetched, so a failed cache write
+            # shouldn't lose it
+            try:
+                write_cache(cache_path, title, description, keywords)
+            except OSError as e:
+                print(f"Could not cache metadata for image: {image_path} ({e})")
             return title, description, keywords
     else:
         # Log failure if the request was unsuccessful
@@ -93,6 +243,149 @@ def get_image_metadata(image_path, custom_context):
     return None, None, []
 
 
+class ImageProcessingWorker(QObject):
+    """
+    Processes a folder of images in a background thread, reporting progress
+    and status messages back to the GUI through signals.
+    """
+
+    progress = pyqtSignal(int)
+    log = pyqtSignal(str)
+    finished = pyqtSignal()
+
+    def __init__(self, folder_path):
+        super().__init__()
+        self.folder_path = folder_path
+        self.cancelled = False
+
+    def run(self):
+        # Process the folder and report how it went
+        try:
+            self.process_images_in_folder(self.folder_path)
+            if self.cancelled:
+                self.log.emit("Processing Cancelled")
+            else:
+                self.log.emit("Processing Completed")
+        except Exception as e:
+            self.log.emit(f"Processing Failed: {e}")
+        self.log.emit("Close Window to Exit")
+        self.finished.emit()
+
+    def cancel(self):
+        # Ask the worker to stop after the requests currently in flight
+        self.cancelled = True
+
+    def process_images_in_folder(self, folder_path):
+        with os.scandir(folder_path) as entries:
+            images_to_process = [
+                entry
+                for entry in entries
+                if entry.name.lower().endswith((".jpg", ".jpeg")) and entry.is_file()
+            ]
+        total_images = len(images_to_process)
+        processed_images = 0
+
+        # Read the images already written to an existing CSV file so an
+        # interrupted run can be resumed without uploading them again
+        csv_path = os.path.join(folder_path, "image_metadata.csv")
+        done = set()
+        if os.path.exists(csv_path):
+            with open(csv_path, newline="", encoding="utf-8") as csv_file:
+                done = {row[0] for row in csv.reader(csv_file) if row} - {"Image Name"}
+
+        # Open a CSV file to write the metadata, appending to it when resuming
+        with open(
+            csv_path,
+            mode="a" if done else "w",
+            newline="",
+            encoding="utf-8",
+            buffering=1 << 20,
+        ) as csv_file, ProcessPoolExecutor(
+            # Start encoding processes fresh rather than forking this
+            # multi-threaded process, which can leave a child deadlocked
+            mp_context=multiprocessing.get_context("spawn")
+        ) as encode_pool, ThreadPoolExecutor(
+            max_workers=max_concurrent_requests
+        ) as executor:
+            writer = csv.writer(csv_file)
+            # Write the header row, unless the file already has one
+            if not done:
+                writer.writerow(["Image Name", "Title", "Description", "Keywords"])
+
+            # Submit every image up front; the executor keeps at most
+            # max_concurrent_requests uploads in flight at once
+            futures = {}
+            for entry in images_to_process:
+                filename = entry.name
+                # Skip images already written to the CSV file by a previous run
+                if filename in done:
+                    processed_images += 1
+                    continue
+
+                # Build a custom context for the file name (remove 'g', digits, etc.)
+                custom_context = " ".join(
+                    c
+                    for c in os.path.splitext(filename)[0].split("_")
+                    if not skip_context_part.fullmatch(c)
+                )
+
+                # Request the metadata from the API
+                future = executor.submit(
+                    get_image_metadata,
+                    entry.path,
+                    custom_context,
+                    encode_pool,
+                    entry.stat().st_size,
+                )
+                futures[future] = filename
+
+            # Only report progress when the percentage changes, so large
+            # folders don't repaint the progress bar for every image
+            last_progress = -1
+            if total_images:
+                last_progress = int(round(processed_images / total_images * 100))
+                self.progress.emit(last_progress)
+
+            # Handle the results in the order the requests finish, collecting
+            # rows into batches so the CSV file is written in larger chunks
+            batch = []
+            try:
+                for future in as_completed(futures):
+                    # Stop early when the window is closed
+                    if self.cancelled:
+                        break
+
+                    filename = futures[future]
+                    try:
+                        title, description, keywords = future.result()
+                    except (requests.RequestException, OSError, ValueError) as e:
+                        # Skip an image that failed so the rest of the folder
+                        # is still processed
+                        self.log.emit(f"Failed to process {filename}: {e}")
+                        title, description, keywords = None, None, []
+                    if title and keywords:
+                        # Add the image's metadata to the next batch of CSV rows
+                        batch.append(
+                            [filename, title, description, ", ".join(keywords)]
+                        )
+                        if len(batch) >= csv_batch_size:
+                            writer.writerows(batch)
+                            batch.clear()
+
+                    processed_images += 1
+                    progress = int(round(processed_images / total_images * 100))
+                    if progress != last_progress:
+                        self.progress.emit(progress)
+                        last_progress = progress
+            finally:
+                # Drop any images still queued when leaving early, so they
+                # aren't uploaded after the run has stopped
+                for pending in futures:
+                    pending.cancel()
+                # Write any rows still waiting in the batch, even after an error
+                writer.writerows(batch)
+
+
 class ImageKeywordingTool(QWidget):
     """
     A graphical user interface (GUI) tool for processing a folder of images,
@@ -101,6 +394,8 @@ class ImageKeywordingTool(QWidget):
 
     def __init__(self):
         super().__init__()
+        self.worker_thread = None
+        self.worker = None
         self.initUI()
 
     def initUI(self):
@@ -128,53 +423,43 @@ class ImageKeywordingTool(QWidget):
         selected_folder = QFileDialog.getExistingDirectory(self, "Select Folder")
         if selected_folder:
             self.status_message.setPlainText("Processing Running...")
-            self.process_images_in_folder(selected_folder)
-            self.status_message.append("Processing Completed")
-            self.status_message.append("Close Window to Exit")
-
-    def process_images_in_folder(self, folder_path):
-        images_to_process = [
-            filename
-            for filename in os.listdir(folder_path)
-            if filename.lower().endswith((".jpg", ".jpeg"))
-        ]
-        total_images = len(images_to_process)
-        processed_images = 0
+            self.select_folder_button.setEnabled(False)
 
-        # Open a CSV file to write the metadata
-        with open(
-            os.path.join(folder_path, "image_metadata.csv"),
-            mode="w",
-            newline="",
-            encoding="utf-8",
-        ) as csv_file:
-            writer = csv.writer(csv_file)
-            # Write the header row
-            writer.writerow(["Image Name", "Title", "Description", "Keywords"])
+            # Run the processing in a background thread so the window stays
+            # responsive; progress and messages come back as queued signals
+            self.worker_thread = QThread()
+            self.worker = ImageProcessingWorker(selected_folder)
+            self.worker.moveToThread(self.worker_thread)
+            self.worker_thread.started.connect(self.worker.run)
+            self.worker.progress.connect(
+                self.progress_bar.setValue, Qt.QueuedConnection
+            )
+            self.worker.log.connect(self.status_message.append, Qt.QueuedConnection)
+            self.worker.finished.connect(self.worker_thread.quit)
+            # Clean up only once the thread itself has stopped, so a new run
+            # can't replace a thread that is still running
+            self.worker_thread.finished.connect(self.processing_finished)
+            self.worker_thread.finished.connect(self.worker.deleteLater)
+            self.worker_thread.finished.connect(self.worker_thread.deleteLater)
+            self.worker_thread.start()
 
-            for filename in images_to_process:
-                image_path = os.path.join(folder_path, filename)
-                # Build a custom context for the file name (remove 'g', digits, etc.)
-                custom_context = " ".join(
-                    [
-                        c
-                        for c in filename.split(".")[0].split("_")
-                        if c != "g" and not c.isdigit()
-                    ]
-                )
+    def processing_finished(self):
+        # Allow another folder to be selected once processing is done; the
+        # thread and worker are deleted by Qt, so drop the references to them
+        self.worker_thread = None
+        self.worker = None
+        self.select_folder_button.setEnabled(True)
 
-                # Request the metadata from the API
-                title, description, keywords = get_image_metadata(
-                    image_path, custom_context
-                )
-                if title and keywords:
-                    # Write the image's metadata to the CSV file
-                    writer.writerow([filename, title, description, ", ".join(keywords)])
-
-                processed_images += 1
-                progress = processed_images / total_images * 100
-                self.progress_bar.setValue(int(round(progress)))
-                QApplication.processEvents()
+    def closeEvent(self, event):
+        # Stop a running worker and close once its in-flight requests are done.
+        # The window is hidden instead of blocking the event loop while waiting.
+        if self.worker_thread is not None and self.worker_thread.isRunning():
+            self.worker.cancel()
+            self.worker_thread.finished.connect(self.close)
+            self.hide()
+            event.ignore()
+            return
+        super().closeEvent(event)
 
 
 def main():